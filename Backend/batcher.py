@@ -0,0 +1,96 @@
+import asyncio
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class Batcher:
+    """Coalesce concurrent single-image requests into one model invocation.
+
+    Requests submitted within ``max_delay`` seconds of each other (up to ``max_batch`` of them)
+    are stacked into a single batch and run with ``run_batch`` on ``executor`` (so the event loop
+    stays free); each caller gets back its own row of the output. ``max_pending`` caps how many
+    requests may be waiting at once.
+    """
+
+    def __init__(self, run_batch, executor=None, max_batch=8, max_delay=0.01, max_pending=64):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._queue = None
+        self._semaphore = None
+        self._task = None
+        # Requests taken off the queue whose results have not been handed out yet
+        self._batch = []
+
+    def start(self):
+        # Must be called from the running event loop (FastAPI startup)
+        self._queue = asyncio.Queue()
+        self._semaphore = asyncio.Semaphore(self.max_pending)
+        self._task = asyncio.create_task(self._loop())
+        logger.info("Batcher started (max_batch=%s, max_delay=%ss)", self.max_batch, self.max_delay)
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        # Fail the batch that was running and everything still queued, so no caller waits forever
+        pending = [fut for _, fut in self._batch]
+        self._batch = []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait()[1])
+        for fut in pending:
+            if not fut.done():
+                fut.set_exception(RuntimeError("Batcher stopped before the request was processed"))
+        if pending:
+            logger.warning("Batcher stopped with %s pending requests", len(pending))
+
+    async def submit(self, img):
+        # img is a (1, H, W, C) array that must not be reused by the caller until the result is back
+        if self._task is None:
+            raise RuntimeError("Batcher is not running")
+        async with self._semaphore:
+            fut = asyncio.get_running_loop().create_future()
+            await self._queue.put((img, fut))
+            return await fut
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = self._batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(items) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            batch = np.concatenate([img for img, _ in items])
+            try:
+                preds = await loop.run_in_executor(self.executor, self.run_batch, batch)
+            except Exception as e:
+                logger.exception("Batched inference failed for %s requests: %s", len(items), str(e))
+                for _, fut in items:
+                    if not fut.done():
+                        fut.set_exception(e)
+                self._batch = []
+                continue
+
+            for i, (_, fut) in enumerate(items):
+                # the caller may have gone away (client disconnect cancels the future)
+                if not fut.done():
+                    fut.set_result(preds[i])
+            self._batch = []
@@ -1,16 +1,92 @@
-from fastapi import FastAPI, UploadFile, File
+import os
+
+# Thread pools are sized per uvicorn worker process so N workers don't each spin up #cores TF threads.
+# These must be set before TensorFlow is imported (via model_loader). Values already in the environment are
+# kept, and the final TF_NUM_*_THREADS values are what ModelLoader, TFLite and ONNX Runtime are sized with.
+WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+THREADS_PER_WORKER = max(1, (os.cpu_count() or 1) // WORKERS)
+os.environ.setdefault("TF_ENABLE_ONEDNN_OPTS", "1")
+os.environ.setdefault("OMP_NUM_THREADS", str(THREADS_PER_WORKER))
+os.environ.setdefault("TF_NUM_INTRAOP_THREADS", str(THREADS_PER_WORKER))
+os.environ.setdefault("TF_NUM_INTEROP_THREADS", "1")
+
+
+def thread_count(name):
+    # TF documents 0 as "use all cores"; read it as this worker's share of the cores instead of clamping it to 1
+    return max(1, int(os.environ[name]) or THREADS_PER_WORKER)
+
+
+INTRA_OP_THREADS = thread_count("TF_NUM_INTRAOP_THREADS")
+INTER_OP_THREADS = thread_count("TF_NUM_INTEROP_THREADS")
+if os.getenv("SKD_QUANTIZE", "").strip().lower() == "int8":
+    # oneDNN INT8 kernels need constant folding disabled (Intel Extension for TensorFlow)
+    os.environ.setdefault("ITEX_TF_CONSTANT_FOLDING", "0")
+
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from model_loader import ModelLoader
+from batcher import Batcher
+from result_cache import ResultCache
 from fastapi.responses import JSONResponse
+import orjson
 import uvicorn
+import asyncio
 import logging
 import traceback
-
-app = FastAPI(title="Skin Cancer AI Backend API")
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
 # Configure logging``
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
+logger.info("Worker threads: intra-op=%s, inter-op=%s (WEB_CONCURRENCY=%s, cpu_count=%s)", INTRA_OP_THREADS, INTER_OP_THREADS, WORKERS, os.cpu_count())
+
+# Size of the thread pool that runs blocking TF work (preprocessing, inference, Grad-CAM) off the event loop
+EXECUTOR_WORKERS = min(4, INTRA_OP_THREADS)
+# Most /predict requests coalesced into one model call; ModelLoader sizes its TFLite interpreters to match
+MAX_BATCH = 8
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the model once per worker process when it starts serving, not at import time
+    try:
+        ml = ModelLoader(num_threads=INTRA_OP_THREADS, inter_op_threads=INTER_OP_THREADS, max_batch=MAX_BATCH)
+        logger.info("Model loaded successfully")
+    except Exception as e:
+        logger.exception("Failed to load model at startup: %s", str(e))
+        # Re-raise so uvicorn shows the error and prevents the server from running if the model fails
+        raise
+
+    # One executor per lifespan, so a restarted app (e.g. a second TestClient) never uses a shut-down pool
+    executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="inference")
+    # Coalesce concurrent /predict requests into batched model calls
+    batcher = Batcher(ml.run_batch, executor=executor, max_batch=MAX_BATCH, max_delay=0.01)
+    batcher.start()
+    app.state.ml = ml
+    app.state.executor = executor
+    app.state.batcher = batcher
+    # Re-uploads of the same image (retries, double submits) are answered without touching the model. The
+    # caches live with the model, so a restarted app never serves results from a previous one.
+    app.state.prediction_cache = ResultCache(max_entries=1024)
+    app.state.explanation_cache = ResultCache(max_entries=256)
+    try:
+        yield
+    finally:
+        await batcher.stop()
+        executor.shutdown(wait=False)
+
+
+class ORJSONResponse(JSONResponse):
+    # orjson serializes faster and more compactly than the stdlib json encoder
+    media_type = "application/json"
+
+    def render(self, content):
+        return orjson.dumps(content)
+
+
+app = FastAPI(title="Skin Cancer AI Backend API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Allow frontend to talk to backend
 app.add_middleware(
@@ -20,15 +96,42 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compress larger responses (e.g. base64 heatmaps); small JSON bodies are sent as-is
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Uploads are read in chunks and rejected as soon as they exceed this size
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Leading bytes of the image formats OpenCV can decode for us
+IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",              # JPEG
+    b"\x89PNG\r\n\x1a\n",         # PNG
+    b"BM",                        # BMP
+    b"II*\x00", b"MM\x00*",       # TIFF
+)
+
+
+def is_image(header):
+    if header.startswith(IMAGE_SIGNATURES):
+        return True
+    # WebP: RIFF container with a WEBP form type
+    return header[:4] == b"RIFF" and header[8:12] == b"WEBP"
+
+
+async def read_upload(image: UploadFile):
+    chunks = []
+    total = 0
+    while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+        if not chunks and not is_image(chunk[:12]):
+            raise HTTPException(status_code=415, detail="Uploaded file is not a supported image")
+        total += len(chunk)
+        if total > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"Image larger than {MAX_UPLOAD_BYTES} bytes")
+        chunks.append(chunk)
+    if not chunks:
+        raise HTTPException(status_code=400, detail="Uploaded file is empty")
+    return b"".join(chunks)
 
-# Load model
-try:
-    ml = ModelLoader()
-    logger.info("Model loaded successfully")
-except Exception as e:
-    logger.exception("Failed to load model at startup: %s", str(e))
-    # Re-raise so uvicorn shows the error and prevents the server from running if the model fails
-    raise
 
 @app.get("/")
 def root():
@@ -36,28 +139,41 @@ def root():
 
 
 @app.get("/diagnose")
-def diagnose():
+def diagnose(request: Request):
     # Provide a small diagnostic endpoint that returns model output shape and classes length
     try:
+        ml = request.app.state.ml
         output_shape = getattr(ml.model, 'output_shape', None)
         class_count = len(ml.class_names)
         # also provide a sample of the class names (up to 20) for quick inspection
         class_sample = ml.class_names[:20] if hasattr(ml, 'class_names') else []
-        return {
+        return ORJSONResponse({
             "model_output_shape": list(output_shape) if output_shape is not None else None,
             "class_count": class_count
             ,"class_sample": class_sample
-        }
+        })
     except Exception as e:
         logger.exception("Error in /diagnose endpoint: %s", str(e))
-        return JSONResponse({"error": "Server error during diagnose", "detail": str(e)}, status_code=500)
+        return ORJSONResponse({"error": "Server error during diagnose", "detail": str(e)}, status_code=500)
 
 @app.post("/predict")
-async def predict(image: UploadFile = File(...)):
-    img_bytes = await image.read()
+async def predict(request: Request, image: UploadFile = File(...)):
+    img_bytes = await read_upload(image)
+    ml = request.app.state.ml
+    prediction_cache = request.app.state.prediction_cache
     try:
-        pred_class, pred_index, confidence = ml.predict(img_bytes)
-        return JSONResponse({
+        cache_key = prediction_cache.key(img_bytes)
+        cached = prediction_cache.get(cache_key)
+        if cached is not None:
+            pred_class, pred_index, confidence = cached
+        else:
+            # preprocess into a fresh array: the batcher holds on to it until the batch is flushed
+            loop = asyncio.get_running_loop()
+            img = await loop.run_in_executor(request.app.state.executor, ml.preprocess, img_bytes, ml.allocate_input())
+            preds = await request.app.state.batcher.submit(img)
+            pred_class, pred_index, confidence = ml.decode(preds)
+            prediction_cache.put(cache_key, (pred_class, pred_index, confidence))
+        return ORJSONResponse({
             "prediction": pred_class,
             "confidence": confidence
         })
@@ -66,17 +182,26 @@ async def predict(image: UploadFile = File(...)):
         logger.exception("Error during prediction: %s", str(e))
         # For local dev/debugging: return the exception string so the frontend can display more details
         # In production, remove the 'detail' field or use a safe error message
-        return JSONResponse({"error": "Server error during prediction", "detail": str(e)}, status_code=500)
+        return ORJSONResponse({"error": "Server error during prediction", "detail": str(e)}, status_code=500)
 
 @app.post("/explain")
-async def explain(image: UploadFile = File(...)):
-    img_bytes = await image.read()
+async def explain(request: Request, image: UploadFile = File(...)):
+    img_bytes = await read_upload(image)
+    ml = request.app.state.ml
+    explanation_cache = request.app.state.explanation_cache
     try:
-        heatmap_path = ml.explain(img_bytes)
-        return {"heatmap": heatmap_path}
+        cache_key = explanation_cache.key(img_bytes)
+        heatmap_b64 = explanation_cache.get(cache_key)
+        if heatmap_b64 is None:
+            loop = asyncio.get_running_loop()
+            heatmap_b64 = await loop.run_in_executor(request.app.state.executor, ml.explain, img_bytes)
+            explanation_cache.put(cache_key, heatmap_b64)
+        return ORJSONResponse({"heatmap_png_b64": heatmap_b64})
     except Exception as e:
         logger.exception("Error during explanation generation: %s", str(e))
-        return JSONResponse({"error": "Server error during explanation generation", "detail": str(e)}, status_code=500)
+        return ORJSONResponse({"error": "Server error during explanation generation", "detail": str(e)}, status_code=500)
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=5000, reload=True)
+    # No auto-reload here: it spawns a file watcher and reloads the model on every edit. Use
+    # `uvicorn main:app --reload` (see dev-run.ps1) for development.
+    uvicorn.run("main:app", host="0.0.0.0", port=5000, workers=WORKERS, reload=False)
@@ -1,23 +1,79 @@
+import base64
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing import image
 import cv2
 import json
-import tempfile
+import os
 import logging
-import shutil
-from datetime import datetime
+import tempfile
+import threading
+import time
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+def infer_output_units(output_shape):
+    # output_shape may be e.g. (None, N) or (None, rows, cols, N) depending on model;
+    # return the last positive integer dimension, or None if there is none
+    if not output_shape:
+        return None
+    for dim in reversed(list(output_shape)):
+        if isinstance(dim, int) and dim > 0:
+            return dim
+    return None
+
+
+def reconcile_class_names(class_names, units):
+    # Pad with class_{i} placeholders or truncate so there is exactly one name per model output.
+    # This prevents runtime IndexError while warning the developer.
+    if len(class_names) < units:
+        placeholders = [f"class_{i}" for i in range(len(class_names), units)]
+        logger.warning("Extended class names with placeholders: %s", placeholders)
+        return class_names + placeholders
+    logger.warning("Truncated class names. Removed: %s", class_names[units:])
+    return class_names[:units]
+
+
 class ModelLoader:
-    def __init__(self):
+    def __init__(self, num_threads=None, inter_op_threads=None, max_batch=8):
+        # num_threads sizes TF's intra-op pool, the TFLite interpreter and ONNX Runtime; with several server
+        # workers each process passes its share of the cores so they don't oversubscribe the CPU. Both
+        # default to the TF_NUM_INTRAOP_THREADS / TF_NUM_INTEROP_THREADS env vars when not given.
+        self.num_threads = num_threads or int(os.getenv("TF_NUM_INTRAOP_THREADS", "0")) or os.cpu_count()
+        self.inter_op_threads = inter_op_threads or int(os.getenv("TF_NUM_INTEROP_THREADS", "0")) or 1
+        self._configure_tf_threads()
+        # Largest batch run_batch() is called with (the batcher's max_batch); TFLite interpreters are sized up to it
+        self.max_batch = max_batch
+
         # Resolve paths relative to repository root (two levels up from this file)
         repo_root = Path(__file__).resolve().parents[1]
         self.model_path = repo_root / "model" / "model.h5"
         self.classes_path = repo_root / "model" / "classes.json"
+        # Opt-in INT8 post-training quantization of the TFLite model (SKD_QUANTIZE=int8); float16 TFLite otherwise
+        self.quantize = os.getenv("SKD_QUANTIZE", "").strip().lower()
+        if self.quantize not in ("", "int8"):
+            logger.warning("Unsupported SKD_QUANTIZE=%s; only 'int8' is supported. Ignoring.", self.quantize)
+            self.quantize = ""
+        # TFLite flatbuffer cached next to model.h5 and reused while model.h5 is unchanged
+        tflite_name = f"{self.model_path.stem}.int8.tflite" if self.quantize == "int8" else f"{self.model_path.stem}.tflite"
+        self.tflite_path = self.model_path.with_name(tflite_name)
+        # Optional ONNX Runtime serving (SKD_RUNTIME=onnx, needs tf2onnx + onnxruntime); TFLite is the default
+        self.runtime = os.getenv("SKD_RUNTIME", "tflite").strip().lower()
+        self.onnx_path = self.model_path.with_suffix(".onnx")
+        # Per-thread input buffer reused by preprocess() across requests
+        self._local = threading.local()
+        # TFLite interpreters are not thread-safe
+        self._interpreter_lock = threading.Lock()
+
+        # Run on the GPU with float16 compute (Tensor Cores) when CUDA is available; otherwise stay on the CPU
+        # path. The float16 copy of the model is built after loading (see _to_mixed_precision).
+        gpus = tf.config.list_physical_devices("GPU")
+        self.use_gpu = bool(gpus)
+        if self.use_gpu:
+            for gpu in gpus:
+                tf.config.experimental.set_memory_growth(gpu, True)
+            logger.info("Found %s GPU(s); serving with mixed_float16 precision", len(gpus))
 
         try:
             logger.info("Loading model from %s", self.model_path)
@@ -27,6 +83,77 @@ class ModelLoader:
             # re-raise so server startup shows the error
             raise
 
+        # Derive the input resolution from the model instead of hardcoding it, so preprocessing always matches
+        # what the network was trained on (and keeps working if it is retrained at another size)
+        input_shape = self.model.input_shape
+        if len(input_shape) != 4 or input_shape[3] != 3 or not input_shape[1] or not input_shape[2]:
+            raise ValueError(f"Expected a single (None, H, W, 3) model input, got {input_shape}")
+        _, height, width, _ = input_shape
+        self._in_hw = (height, width)
+        # OpenCV takes sizes as (width, height)
+        self._in_wh = (width, height)
+        logger.info("Model input size: height=%s, width=%s", height, width)
+
+        # On GPU, serve from a mixed_float16 copy. self.model always stays full precision for Grad-CAM.
+        # SKD_QUANTIZE=int8 is applied by the TFLite converter below; Keras' own model.quantize("int8") is not
+        # used because serving it through Keras is slower than the float16 TFLite interpreter.
+        self.serving_model = self.model
+        if self.use_gpu:
+            if self.quantize == "int8":
+                logger.warning("SKD_QUANTIZE=int8 only applies to the CPU TFLite path; serving mixed_float16 on GPU")
+            try:
+                self.serving_model = self._to_mixed_precision(self.model)
+            except Exception as e:
+                logger.exception("Building the mixed_float16 model failed, serving the float32 model: %s", str(e))
+
+        # Feed inputs in the dtype the serving model's input takes (float16 for the mixed_float16 GPU model) so
+        # requests never build a float32 tensor that the graph immediately casts down again. On CPU this is
+        # float32, which is also what TFLite and ONNX Runtime take.
+        self.input_dtype = self._input_dtype(self.serving_model)
+        logger.info("Model input dtype: %s", self.input_dtype)
+
+        # Compile the Keras forward pass and the Grad-CAM computation once as statically-shaped graphs
+        # so requests never pay Keras predict() dispatch overhead or retracing
+        input_spec = tf.TensorSpec((None, *self._in_hw, 3), tf.as_dtype(self.input_dtype))
+        self._grad_model = self._build_grad_model(self.model)
+        self._predict_fn = tf.function(lambda x: self.serving_model(x, training=False), input_signature=[input_spec])
+        # XLA-compile Grad-CAM so the backward pass and the weighted channel reduction are fused
+        self._gradcam_fn = tf.function(self._gradcam, input_signature=[input_spec], jit_compile=True)
+
+        # The output shape is fixed at load time, so pick the per-image postprocessing once:
+        # (None, C) outputs are used as-is, spatial (None, H, W, C) outputs are averaged down to (C,)
+        output_rank = len(self.model.output_shape)
+        if output_rank == 2:
+            self._postprocess = lambda p: p
+        elif output_rank == 4:
+            self._postprocess = lambda p: p.mean(axis=(0, 1))
+        else:
+            self._postprocess = lambda p: p.reshape(-1, p.shape[-1]).mean(axis=0)
+
+        # On CPU, serve predictions from ONNX Runtime (if requested) or a quantized TFLite interpreter; the Keras
+        # model is kept for explain() (Grad-CAM needs gradients). On GPU, or if conversion fails, we serve with
+        # the Keras model.
+        self.session = None
+        self.interpreters = None
+        if self.serving_model is self.model and not self.use_gpu:
+            if self.runtime == "onnx" and self.quantize == "int8":
+                logger.warning("SKD_RUNTIME=onnx exports the float model; serving the INT8 TFLite model instead")
+            elif self.runtime == "onnx":
+                try:
+                    self._init_onnx()
+                    logger.info("Serving predictions with ONNX Runtime from %s", self.onnx_path)
+                except Exception as e:
+                    self.session = None
+                    logger.exception("Failed to prepare ONNX Runtime session, falling back to TFLite: %s", str(e))
+            if self.session is None:
+                try:
+                    self._ensure_tflite()
+                    self._init_tflite()
+                    logger.info("Serving predictions with TFLite interpreters for batch sizes %s from %s", list(self.interpreters), self.tflite_path)
+                except Exception as e:
+                    self.interpreters = None
+                    logger.exception("Failed to prepare TFLite interpreter, falling back to Keras predict: %s", str(e))
+
         try:
             with open(self.classes_path, "r") as f:
                 self.class_names = json.load(f)
@@ -34,149 +161,343 @@ class ModelLoader:
             logger.exception("Failed to load classes.json at %s: %s", self.classes_path, str(e))
             raise
 
-        # Validate the model output shape matches the number of classes to avoid runtime failures
+        # Validate the model output shape matches the number of classes to avoid runtime failures.
+        # Mismatches are only fixed in memory here; tools/reconcile_classes.py updates classes.json on disk,
+        # so multiple workers never race to rewrite the file at startup.
         try:
             output_shape = getattr(self.model, 'output_shape', None)
-            # output_shape may be e.g. (None, N) or (None, rows, cols, N) depending on model
-            # find the last non-None integer in output_shape
-            inferred_units = None
-            if output_shape:
-                out_shape = list(output_shape)
-                # try to find a positive integer in the last axis
-                for dim in reversed(out_shape):
-                    if isinstance(dim, int) and dim > 0:
-                        inferred_units = dim
-                        break
-
+            inferred_units = infer_output_units(output_shape)
             classes_len = len(self.class_names) if self.class_names is not None else 0
             logger.info("Model output_shape=%s, inferred_units=%s, classes_len=%s", output_shape, inferred_units, classes_len)
 
-            # If inferred_units is known and differs from classes length, auto-adjust class_names
-            # by padding or truncating. This prevents runtime IndexError while warning the developer.
             if inferred_units is not None and inferred_units != classes_len:
-                logger.warning("Model output shape units (%s) do not match classes.json length (%s). Auto-adjusting in memory and on-disk.", inferred_units, classes_len)
-                if classes_len < inferred_units:
-                    # pad with placeholders class_{i}
-                    placeholders = [f"class_{i}" for i in range(classes_len, inferred_units)]
-                    self.class_names.extend(placeholders)
-                    logger.warning("Extended classes.json in-memory with placeholders: %s", placeholders)
-                else:
-                    # truncate the list to match model output
-                    removed = self.class_names[inferred_units:]
-                    self.class_names = self.class_names[:inferred_units]
-                    logger.warning("Truncated classes.json in-memory. Removed: %s", removed)
-                # Attempt to persist the change: create a timestamped backup first, then overwrite classes.json
-                try:
-                    # backup original file
-                    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-                    backup_path = str(self.classes_path) + f".bak-{timestamp}"
-                    shutil.copyfile(str(self.classes_path), backup_path)
-                    logger.info("Backed up original classes.json to %s", backup_path)
-
-                    # write the updated class list back to disk
-                    with open(self.classes_path, 'w', encoding='utf-8') as f:
-                        json.dump(self.class_names, f, indent=4)
-                    logger.info("Updated classes.json on disk with %s entries.", len(self.class_names))
-                except Exception as e:
-                    logger.exception("Failed to backup or write classes.json: %s", str(e))
+                logger.warning("Model output shape units (%s) do not match classes.json length (%s). Auto-adjusting in memory; run tools/reconcile_classes.py to update classes.json.", inferred_units, classes_len)
+                self.class_names = reconcile_class_names(self.class_names, inferred_units)
         except Exception:
             # Re-raise so startup fails with the message (user should fix classes or model)
             logger.exception("Model/class count validation failed")
             raise
 
-    def preprocess(self, img_bytes):
-        temp = tempfile.NamedTemporaryFile(delete=False)
-        temp.write(img_bytes)
-        temp.close()
+        # Pay one-time costs (graph tracing, kernel selection, XLA/XNNPACK compilation) before serving traffic
+        self._warmup(input_spec)
 
-        img = image.load_img(temp.name, target_size=(75, 100))
-        img_array = image.img_to_array(img)
-        img_array = np.expand_dims(img_array, axis=0) / 255.0
-        return img_array
+    def _warmup(self, input_spec):
+        # Run a dummy image through the active inference path and Grad-CAM so the first request is fast.
+        # Failures are logged rather than raised; the request that hits the broken path will report it.
+        # Every batch size the batcher can send is run once, so each TFLite interpreter (and each input shape in
+        # the other runtimes) is warm before traffic arrives
+        batch = np.zeros((self.max_batch, *self._in_hw, 3), dtype=self.input_dtype)
 
-    def predict(self, img_bytes):
+        start = time.perf_counter()
         try:
-            img = self.preprocess(img_bytes)
+            for size in range(1, self.max_batch + 1):
+                self.run_batch(batch[:size])
+            logger.info("Warmed up predict (%s, batch sizes 1-%s) in %.1f ms", self._runtime_name(), self.max_batch, (time.perf_counter() - start) * 1000)
         except Exception as e:
-            logger.exception("Failed to preprocess image: %s", str(e))
-            raise
+            logger.exception("Warmup of predict failed: %s", str(e))
+
+        # Grad-CAM is warmed up on non-zero images: the first call compiles the graph, and a second, different
+        # image checks that later requests reuse it instead of recompiling
+        first, second = np.random.default_rng(0).random((2, 1, *self._in_hw, 3)).astype(self.input_dtype)
+        start = time.perf_counter()
+        try:
+            self._gradcam_fn(tf.constant(first))
+        except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError) as e:
+            # e.g. an op without an XLA kernel on this platform; keep Grad-CAM as a plain graph
+            logger.warning("XLA compilation of Grad-CAM failed, using a non-XLA graph: %s", str(e))
+            self._gradcam_fn = tf.function(self._gradcam, input_signature=[input_spec])
+            try:
+                self._gradcam_fn(tf.constant(first))
+            except Exception as e:
+                logger.exception("Warmup of compiled Grad-CAM graph failed: %s", str(e))
+                return
+        except Exception as e:
+            logger.exception("Warmup of Grad-CAM failed: %s", str(e))
+            return
+        compile_ms = (time.perf_counter() - start) * 1000
 
+        start = time.perf_counter()
         try:
-            preds_raw = self.model.predict(img)
-            # Convert to numpy array and reduce spatial dims if needed to produce class vector
-            preds = np.asarray(preds_raw)
-            # Remove leading batch dimension if present
-            if preds.ndim >= 2 and preds.shape[0] == 1:
-                preds = preds[0]
-            # If multi-dimensional (e.g., H, W, C), reduce spatial dimensions by mean to get (C,)
-            if preds.ndim > 1:
-                # average across all axes except the last
-                reduce_axes = tuple(range(preds.ndim - 1))
-                preds = preds.mean(axis=reduce_axes)
-            preds = np.asarray(preds).ravel()
+            self._gradcam_fn(tf.constant(second))
         except Exception as e:
-            # Log the shape and dtype to help debug keras errors
+            logger.exception("Grad-CAM failed on the second warmup image: %s", str(e))
+            return
+        steady_ms = (time.perf_counter() - start) * 1000
+        logger.info("Warmed up Grad-CAM in %.1f ms; a new image then took %.1f ms", compile_ms, steady_ms)
+        if steady_ms > compile_ms / 2:
+            logger.warning("Grad-CAM on a new image took about as long as the first compile; it may be recompiling per request")
+
+    def _runtime_name(self):
+        if self.session is not None:
+            return "onnxruntime"
+        if self.interpreters is not None:
+            return "tflite"
+        return "keras"
+
+    def _configure_tf_threads(self):
+        # TF only accepts thread pool sizes before its runtime initializes; a second ModelLoader in the same
+        # process (e.g. the app started twice) keeps the existing pools instead of failing
+        try:
+            if tf.config.threading.get_intra_op_parallelism_threads() != self.num_threads:
+                tf.config.threading.set_intra_op_parallelism_threads(self.num_threads)
+            if tf.config.threading.get_inter_op_parallelism_threads() != self.inter_op_threads:
+                tf.config.threading.set_inter_op_parallelism_threads(self.inter_op_threads)
+        except RuntimeError as e:
+            logger.warning("TensorFlow is already initialized; keeping its existing thread pools: %s", str(e))
+
+    @staticmethod
+    def _build_grad_model(model):
+        # Grad-CAM needs the feature maps of the last conv block, not whatever sits a fixed offset from the end
+        # (in model.h5, layers[-3] is Dense(512))
+        conv_layer = next((l for l in reversed(model.layers) if isinstance(l, tf.keras.layers.Conv2D)), None)
+        if conv_layer is None:
+            raise ValueError("Grad-CAM needs a Conv2D layer, but the model has none")
+
+        # A Sequential restored from model.h5 has several inbound nodes per layer, so conv_layer.output may
+        # belong to a different graph than model.outputs and the gradient between them would be None.
+        # Re-apply the (shared) layers to one fresh input so both outputs come from the same graph.
+        x = inputs = tf.keras.Input(shape=model.input_shape[1:])
+        for layer in model.layers:
+            x = layer(x)
+            if layer is conv_layer:
+                conv_output = x
+        if len(conv_output.shape) != 4:
+            raise ValueError(f"Expected a (None, H, W, C) output from {conv_layer.name}, got {conv_output.shape}")
+        logger.info("Grad-CAM target layer: %s %s", conv_layer.name, conv_output.shape)
+        return tf.keras.Model(inputs, [conv_output, x])
+
+    @staticmethod
+    def _to_mixed_precision(model):
+        # Layers restored from model.h5 keep their saved float32 dtype policy, so setting the global
+        # mixed_float16 policy has no effect on them. Rebuild the model with every layer on mixed_float16
+        # (float16 compute, float32 variables) and copy the weights over. The final layer (softmax) stays
+        # float32 so probabilities are computed at full precision. clone_function is never applied to the
+        # InputLayer, so the model is rebuilt on a float16 Input; otherwise Keras casts the float16 batch up to
+        # float32 at the input and the first layer casts it straight back down.
+        last_layer = model.layers[-1]
+
+        def clone_layer(layer):
+            config = layer.get_config()
+            config["dtype"] = "float32" if layer is last_layer else "mixed_float16"
+            return layer.__class__.from_config(config)
+
+        inputs = tf.keras.Input(shape=model.input_shape[1:], dtype="float16")
+        mixed = tf.keras.models.clone_model(model, input_tensors=inputs, clone_function=clone_layer)
+        mixed.set_weights(model.get_weights())
+        logger.info("Rebuilt model with mixed_float16 layers (final layer kept in float32)")
+        return mixed
+
+    @staticmethod
+    def _input_dtype(model):
+        # Keras converts every input to the dtype of model.inputs[0], so feed exactly that: float16 for the
+        # mixed_float16 GPU model, float32 otherwise
+        dtype = np.dtype(tf.as_dtype(model.inputs[0].dtype).as_numpy_dtype)
+        return dtype if dtype == np.float16 else np.dtype(np.float32)
+
+    def _representative_dataset(self, calibration_dir):
+        # Yield preprocessed calibration images for TFLite full-integer quantization
+        paths = sorted(p for p in Path(calibration_dir).iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png", ".bmp"))
+        for path in paths[:200]:
             try:
-                logger.error("Prediction failed. Input shape: %s, dtype: %s", getattr(img, 'shape', 'unknown'), getattr(img, 'dtype', 'unknown'))
-            except Exception:
-                pass
-            logger.exception("Model.predict raised an exception: %s", str(e))
-            raise
-        # Validate predictions and class names
+                yield [self.preprocess(path.read_bytes(), out=self.allocate_input())]
+            except Exception as e:
+                logger.warning("Skipping calibration image %s: %s", path, str(e))
+
+    def _init_onnx(self):
+        # Imported lazily: tf2onnx and onnxruntime are only needed with SKD_RUNTIME=onnx
+        import onnxruntime as ort
+
+        # model.onnx is stamped with model.h5's mtime; re-export only when they differ
+        model_mtime = self.model_path.stat().st_mtime
+        if not (self.onnx_path.exists() and self.onnx_path.stat().st_mtime == model_mtime):
+            import tf2onnx
+
+            logger.info("Exporting %s to ONNX", self.model_path)
+            input_signature = (tf.TensorSpec((None, *self._in_hw, 3), tf.float32, name="input"),)
+            # from_keras relies on tf.keras 2 internals and cannot convert the Keras 3 model stored in model.h5,
+            # so export a tf.function over the model instead
+            export_fn = tf.function(lambda x: self.model(x, training=False), input_signature=input_signature)
+            tmp_path = self.onnx_path.with_name(f"{self.onnx_path.name}.tmp-{os.getpid()}")
+            tf2onnx.convert.from_function(export_fn, input_signature=input_signature, output_path=str(tmp_path))
+            os.utime(tmp_path, (model_mtime, model_mtime))
+            os.replace(tmp_path, self.onnx_path)
+            logger.info("Saved ONNX model to %s", self.onnx_path)
+
+        so = ort.SessionOptions()
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        so.intra_op_num_threads = self.num_threads
+        self.session = ort.InferenceSession(str(self.onnx_path), sess_options=so, providers=["CPUExecutionProvider"])
+        self._onnx_input_name = self.session.get_inputs()[0].name
+
+        # Check the exported graph against the Keras model before serving from it
+        sample = np.random.default_rng(0).random((2, *self._in_hw, 3), dtype=np.float32)
+        expected = self.model(sample, training=False).numpy()
+        actual = self.session.run(None, {self._onnx_input_name: sample})[0]
+        max_diff = float(np.max(np.abs(expected - actual)))
+        logger.info("ONNX vs Keras max abs difference on a sample batch: %.2e", max_diff)
+        if max_diff > 1e-3:
+            raise RuntimeError(f"ONNX model output differs from the Keras model (max abs diff {max_diff:.2e})")
+
+    def _init_tflite(self):
+        # One interpreter per power-of-two batch size up to max_batch (1, 2, 4, 8), each allocated once; a batch
+        # runs on the smallest one that fits, zero-padded. Resizing a single interpreter whenever the batch size
+        # changes re-plans its arena and re-prepares the XNNPACK delegate, and one interpreter per exact size
+        # costs ~20 MB each per worker. With buckets a batch is padded by less than 2x.
+        sizes = [1]
+        while sizes[-1] < self.max_batch:
+            sizes.append(min(sizes[-1] * 2, self.max_batch))
+
+        self.interpreters = {}
+        for size in sizes:
+            interpreter = tf.lite.Interpreter(model_path=str(self.tflite_path), num_threads=self.num_threads)
+            input_details = interpreter.get_input_details()[0]
+            interpreter.resize_tensor_input(input_details["index"], (size, *self._in_hw, 3))
+            interpreter.allocate_tensors()
+            # padding rows stay zero; their outputs are dropped
+            self.interpreters[size] = (interpreter, np.zeros((size, *self._in_hw, 3), dtype=input_details["dtype"]))
+        self._input_index = input_details["index"]
+        self._output_index = interpreter.get_output_details()[0]["index"]
+
+    def _ensure_tflite(self):
+        # The cached .tflite is stamped with model.h5's mtime; re-convert only when they differ
+        model_mtime = self.model_path.stat().st_mtime
+        if self.tflite_path.exists() and self.tflite_path.stat().st_mtime == model_mtime:
+            logger.info("Using cached TFLite model at %s", self.tflite_path)
+            return
+
+        # from_keras_model relies on tf.keras 2 internals (_get_save_spec) and fails on the Keras 3 model stored
+        # in model.h5 with some TF releases, so convert from an exported SavedModel instead. (from_concrete_functions
+        # does not freeze Keras 3 variables and produces a model without weights.)
+        with tempfile.TemporaryDirectory(prefix="skd-export-") as export_dir:
+            self.model.export(export_dir)
+            converter = tf.lite.TFLiteConverter.from_saved_model(export_dir)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if self.quantize == "int8":
+                # With calibration images (SKD_CALIBRATION_DIR) activations are quantized too; without them
+                # this is dynamic-range quantization (INT8 weights, float activations)
+                calibration_dir = os.getenv("SKD_CALIBRATION_DIR")
+                if calibration_dir:
+                    converter.representative_dataset = lambda: self._representative_dataset(calibration_dir)
+                logger.info("Converting %s to INT8 TFLite model (calibration dir: %s)", self.model_path, calibration_dir)
+            else:
+                converter.target_spec.supported_types = [tf.float16]
+                logger.info("Converting %s to float16 TFLite model", self.model_path)
+            tflite_model = converter.convert()
+
+        # write to a temporary file and rename so concurrent workers never read a partial flatbuffer
+        tmp_path = self.tflite_path.with_name(f"{self.tflite_path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, "wb") as f:
+            f.write(tflite_model)
+        os.utime(tmp_path, (model_mtime, model_mtime))
+        os.replace(tmp_path, self.tflite_path)
+        logger.info("Saved TFLite model to %s (%s bytes)", self.tflite_path, len(tflite_model))
+
+    def preprocess(self, img_bytes, out=None):
+        # Decode in memory with OpenCV and normalize straight into a (1, H, W, 3) buffer of input_dtype
+        # (float16 for the mixed_float16 GPU model, float32 otherwise). The uint8 -> float conversion
+        # and the 1/255 scale happen in one pass with no float64 intermediate.
+        # By default a per-thread buffer is reused, so callers must not hold on to the result.
+        bgr = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if bgr is None:
+            raise ValueError("Uploaded file could not be decoded as an image")
+        # resize first so the color conversion runs on the small image
+        bgr = cv2.resize(bgr, self._in_wh, interpolation=cv2.INTER_AREA)
+        rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+        if out is None:
+            out = getattr(self._local, "input_buffer", None)
+            if out is None:
+                out = self._local.input_buffer = self.allocate_input()
+        np.multiply(rgb, np.float32(1.0 / 255.0), out=out[0])
+        return out
+
+    def allocate_input(self, batch_size=1):
+        # Fresh input array for callers that need to keep the preprocessed image around (e.g. the batcher)
+        return np.empty((batch_size, *self._in_hw, 3), dtype=self.input_dtype)
+
+    def run_batch(self, batch):
+        # Run the model on a (N, H, W, 3) batch and return the raw model outputs
         try:
-            index = int(np.argmax(preds))
+            if self.session is not None:
+                return self.session.run(None, {self._onnx_input_name: batch})[0]
+            if self.interpreters is None:
+                return self._predict_fn(tf.constant(batch)).numpy()
+            n = batch.shape[0]
+            if n > self.max_batch:
+                return np.concatenate([self.run_batch(batch[i:i + self.max_batch]) for i in range(0, n, self.max_batch)])
+            size = next(size for size in self.interpreters if size >= n)
+            interpreter, padded = self.interpreters[size]
+            with self._interpreter_lock:
+                if size != n:
+                    padded[:n] = batch
+                    batch = padded
+                interpreter.set_tensor(self._input_index, batch)
+                interpreter.invoke()
+                return interpreter.get_tensor(self._output_index)[:n]
         except Exception as e:
-            logger.exception("argmax failed on predictions: %s", str(e))
+            # Log the shape and dtype to help debug keras errors
+            logger.error("Prediction failed. Input shape: %s, dtype: %s", getattr(batch, 'shape', 'unknown'), getattr(batch, 'dtype', 'unknown'))
+            logger.exception("Model inference raised an exception: %s", str(e))
             raise
 
-        # Debugging log: shapes and lengths
+    def predict(self, img_bytes):
         try:
-            preds_len = len(preds)
-            classes_len = len(self.class_names)
-        except Exception:
-            preds_len = 'unknown'
-            classes_len = 'unknown'
-        logger.info("Predictions length: %s, classes length: %s, argmax index: %s", preds_len, classes_len, index)
+            img = self.preprocess(img_bytes)
+        except Exception as e:
+            logger.exception("Failed to preprocess image: %s", str(e))
+            raise
+
+        preds_raw = self.run_batch(img)
+        return self.decode(preds_raw[0])
 
-        if isinstance(classes_len, int) and isinstance(index, int) and index >= classes_len:
+    def decode(self, preds):
+        # Turn the model output for a single image (no batch dimension) into (class_name, index, confidence)
+        preds = self._postprocess(preds)
+        index = int(preds.argmax())
+        classes_len = len(self.class_names)
+        logger.info("Predictions length: %s, classes length: %s, argmax index: %s", len(preds), classes_len, index)
+
+        if index >= classes_len:
             # Instead of raising, provide a fallback label and log a warning.
-            # The class name might be a placeholder (if we padded earlier) or we generate one on-the-fly.
-            fallback_label = f"class_{index}"
-            logger.warning("Predicted index %s is out of range for class_names (len=%s). Using fallback label '%s'. Full preds: %s", index, classes_len, fallback_label, np.array2string(preds, precision=4, separator=','))
-            class_name = fallback_label
+            class_name = f"class_{index}"
+            logger.warning("Predicted index %s is out of range for class_names (len=%s). Using fallback label '%s'. Full preds: %s", index, classes_len, class_name, np.array2string(preds, precision=4, separator=','))
+        else:
+            class_name = self.class_names[index]
 
         confidence = float(preds[index])
-        class_name = self.class_names[index]
         return class_name, index, confidence
 
-    def explain(self, img_bytes):
-        img = self.preprocess(img_bytes)
-        grad_model = tf.keras.models.Model(
-            [self.model.inputs],
-            [self.model.get_layer(self.model.layers[-3].name).output, self.model.output]
-        )
-
+    def _gradcam(self, img):
+        # Grad-CAM heatmap at the resolution of the last conv block; compiled once in __init__ as _gradcam_fn.
+        # It runs on the float32 model, so float16 GPU inputs are cast up first (no fp16 gradient underflow).
+        img = tf.cast(img, tf.float32)
         with tf.GradientTape() as tape:
-            conv_outputs, predictions = grad_model(img)
-            class_idx = tf.argmax(predictions[0])
-            loss = predictions[:, class_idx]
+            conv_outputs, predictions = self._grad_model(img, training=False)
+            # score of the predicted class; slicing with a tf.argmax index would make XLA treat the index as a
+            # compile-time constant and recompile the graph for every new image
+            loss = tf.reduce_max(predictions, axis=-1)
 
         grads = tape.gradient(loss, conv_outputs)
         guided_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
-        conv_outputs = conv_outputs[0]
+        # channel-weighted sum of the feature maps as a single contraction
+        return tf.einsum('hwc,c->hw', conv_outputs[0], guided_grads)
 
-        heatmap = tf.reduce_sum(tf.multiply(guided_grads, conv_outputs), axis=-1).numpy()
-        heatmap = np.maximum(heatmap, 0)
+    def explain(self, img_bytes):
+        img = self.preprocess(img_bytes)
+        # cv2.threshold needs float32
+        heatmap = self._gradcam_fn(tf.constant(img)).numpy().astype(np.float32, copy=False)
 
-        heatmap = cv2.resize(heatmap, (100, 75))
+        # Clamp negatives, then scale to [0, 255] and cast in one SIMD pass on the small conv-resolution
+        # heatmap; resizing the uint8 result is cheaper than resizing floats and casting afterwards
+        _, heatmap = cv2.threshold(heatmap, 0, 0, cv2.THRESH_TOZERO)
         max_val = heatmap.max() if heatmap.size > 0 else 0
-        if max_val != 0:
-            heatmap = heatmap / max_val
-        else:
+        if max_val == 0:
             logger.warning("Heatmap has max value 0; normalization skipped.")
+        heatmap_u8 = cv2.convertScaleAbs(heatmap, alpha=(255.0 / max_val) if max_val > 0 else 0)
+        heatmap_u8 = cv2.resize(heatmap_u8, self._in_wh, interpolation=cv2.INTER_LINEAR)
 
-        # Save temporary image
-        heatmap_path = tempfile.NamedTemporaryFile(suffix=".png", delete=False).name
-        cv2.imwrite(heatmap_path, np.uint8(255 * heatmap))
-
-        return heatmap_path
+        # Encode the PNG in memory instead of leaving a temp file behind per request
+        ok, buf = cv2.imencode(".png", heatmap_u8)
+        if not ok:
+            raise RuntimeError("Failed to encode heatmap as PNG")
+        return base64.b64encode(buf).decode("ascii")
@@ -0,0 +1,41 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """Thread-safe LRU of results keyed by a content hash of the uploaded image.
+
+    Uploads larger than ``max_upload_bytes`` get no key and are never cached, so a few big
+    images cannot pin a lot of memory.
+    """
+
+    def __init__(self, max_entries=1024, max_upload_bytes=2 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_upload_bytes = max_upload_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, img_bytes):
+        # Returns None for uploads that should not be cached
+        if len(img_bytes) > self.max_upload_bytes:
+            return None
+        return hashlib.blake2b(img_bytes, digest_size=16).digest()
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if key is None:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
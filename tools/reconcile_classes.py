@@ -0,0 +1,55 @@
+"""Make model/classes.json match the number of outputs of model/model.h5.
+
+The server only pads/truncates class names in memory when they disagree with the model; run this
+once (e.g. after retraining) to persist the fix. The original file is backed up next to it first.
+
+    python tools/reconcile_classes.py
+"""
+import json
+import logging
+import shutil
+import sys
+from datetime import datetime
+from pathlib import Path
+
+repo_root = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(repo_root / "Backend"))
+
+from tensorflow.keras.models import load_model
+from model_loader import infer_output_units, reconcile_class_names
+
+logger = logging.getLogger("reconcile_classes")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s - %(message)s")
+    model_path = repo_root / "model" / "model.h5"
+    classes_path = repo_root / "model" / "classes.json"
+
+    model = load_model(str(model_path), compile=False)
+    units = infer_output_units(getattr(model, 'output_shape', None))
+    with open(classes_path, "r") as f:
+        class_names = json.load(f)
+
+    if units is None or units == len(class_names):
+        logger.info("classes.json already matches the model (%s classes); nothing to do.", len(class_names))
+        return 0
+
+    logger.warning("Model output shape units (%s) do not match classes.json length (%s).", units, len(class_names))
+    class_names = reconcile_class_names(class_names, units)
+
+    # backup original file
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    backup_path = str(classes_path) + f".bak-{timestamp}"
+    shutil.copyfile(str(classes_path), backup_path)
+    logger.info("Backed up original classes.json to %s", backup_path)
+
+    # write the updated class list back to disk
+    with open(classes_path, 'w', encoding='utf-8') as f:
+        json.dump(class_names, f, indent=4)
+    logger.info("Updated classes.json on disk with %s entries.", len(class_names))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())